@@ -83,7 +83,7 @@ if __name__ == '__main__':
     simulation_interface.reset(1)
 
 
-    steps = np.int(np.sqrt(args.num_samples))
+    steps = int(np.sqrt(args.num_samples))
     if not(os.path.exists(args.save_folder)):
         os.makedirs(args.save_folder)
 
@@ -12,7 +12,7 @@ from TrajectoryVAE.utils import MIN_ANGLE, MAX_ANGLE
 
 from AffordanceVAED.ros_monitor import RosPerceptionVAE
 
-from affordance_gym.perception_policy import Predictor, end_effector_pose
+from affordance_gym.perception_policy import Predictor, end_effector_pose, dh_parameters
 
 from affordance_gym.utils import parse_vaed_arguments, parse_traj_arguments, parse_policy_arguments, load_parameters, use_cuda
 from env_setup.env_setup import VAED_MODELS_PATH, TRAJ_MODELS_PATH, POLICY_MODELS_PATH, LOOK_AT, DISTANCE, AZIMUTH, ELEVATION, LOOK_AT_EPSILON, KINECT_EXPERIMENTS_PATH
@@ -48,6 +48,9 @@ def main(args):
     policy_path = os.path.join(POLICY_MODELS_PATH, args.policy_name)
     load_parameters(policy, policy_path, 'model')
 
+    # Forward kinematics params
+    dh_params = dh_parameters(device)
+
     # Kinect data
     log_path = os.path.join(KINECT_EXPERIMENTS_PATH, args.log_name)
 
@@ -68,7 +71,7 @@ def main(args):
     n_azimuths = (kinect_azimuths - (AZIMUTH - AZIMUTH_EPSILON)) / (AZIMUTH_EPSILON * 2)
     n_elevations = (kinect_elevations - (ELEVATION - ELEVATION_EPSILON)) / (ELEVATION_EPSILON * 2)
 
-    camera_params = np.array([n_lookat_xs, n_lookat_ys, n_camera_distances, n_azimuths, n_elevations], np.float)
+    camera_params = np.array([n_lookat_xs, n_lookat_ys, n_camera_distances, n_azimuths, n_elevations], np.float64)
 
     debug_images = np.array(data[:, 13], str)
 
@@ -107,7 +110,7 @@ def main(args):
 
         end_joint_pose = (MAX_ANGLE - MIN_ANGLE) * end_joint_pose + MIN_ANGLE
         # joint pose -> cartesian
-        end_pose = end_effector_pose(end_joint_pose, device)
+        end_pose = end_effector_pose(end_joint_pose, dh_params)
         end_pose = end_pose.cpu().detach().numpy()[0]
 
         end_poses.append(end_pose)
@@ -6,7 +6,7 @@ from torch.autograd import Variable
 import rospy
 
 from affordance_gym.simulation_interface import SimulationInterface
-from affordance_gym.perception_policy import Predictor, end_effector_pose
+from affordance_gym.perception_policy import Predictor, end_effector_pose, dh_parameters
 from affordance_gym.utils import parse_policy_arguments, parse_moveit_arguments, parse_vaed_arguments, parse_traj_arguments, load_parameters,  use_cuda
 
 from affordance_gym.monitor import TrajectoryEnv
@@ -55,6 +55,9 @@ def main(args):
     policy_path = os.path.join(POLICY_MODELS_PATH, args.policy_name)
     load_parameters(policy, policy_path, 'model')
 
+    # Forward kinematics params
+    dh_params = dh_parameters(device)
+
     # Simulation interface
     sim = SimulationInterface(arm_name='lumi_arm')
     sim.change_camere_params(LOOK_AT, DISTANCE, AZIMUTH, ELEVATION)
@@ -125,7 +128,7 @@ def main(args):
             end_joint_pose = (MAX_ANGLE - MIN_ANGLE) * end_joint_pose + MIN_ANGLE
 
             # joint pose -> cartesian
-            end_pose = end_effector_pose(end_joint_pose, device)
+            end_pose = end_effector_pose(end_joint_pose, dh_params)
 
             end_pose = end_pose.detach().cpu().numpy()
             target_pose = np.array([x, y])
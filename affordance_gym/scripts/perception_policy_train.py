@@ -1,14 +1,14 @@
 import os
+from pathlib import Path
 import torch
 import torch.optim as optim
-from torch.autograd import Variable
 from torch.utils import data
 from torch.nn import functional as F
 import numpy as np
 
 from affordance_gym.utils import parse_traj_arguments, parse_vaed_arguments, parse_policy_arguments, parse_policy_train_arguments, save_arguments, use_cuda
 from affordance_gym.utils import plot_loss, plot_scatter, plot_latent_distributions
-from affordance_gym.perception_policy import end_effector_pose, Predictor
+from affordance_gym.perception_policy import end_effector_pose, dh_parameters, Predictor
 
 
 from env_setup.env_setup import LOOK_AT, DISTANCE, AZIMUTH, ELEVATION, ELEVATION_EPSILON, AZIMUTH_EPSILON, DISTANCE_EPSILON, LOOK_AT_EPSILON
@@ -31,83 +31,70 @@ The forward kinematics solver is included to the PyTorch computation graph.
 '''
 
 
-def load_dataset(perception_name, fixed_camera, debug):
+def load_dataset(data_path, fixed_camera, debug):
 
-    data_path = os.path.join(VAED_MODELS_PATH, perception_name, 'mujoco_latents')
-    data_files = os.listdir(data_path)
+    data_files = list(data_path.iterdir())
 
     if debug:
         data_files = [data_files[0], data_files[-2]]
 
-    print("Loading: ", data_files)
+    print("Loading: ", [file.name for file in data_files])
     # Multiple data packages exist
-    latents = []
-    camera_distances = []
-    azimuths = []
-    elevations = []
-    target_coords = []
-    cup_ids = []
-    lookats = []
+    datasets = []
 
     for file in data_files:
-        print(file)
-        dataset = np.load(os.path.join(data_path, file))
+        print(file.name)
+        # The packages are pickled tuples of arrays
+        datasets.append(np.load(file, allow_pickle=True))
+
+    num_samples = sum(dataset[0].shape[0] for dataset in datasets)
+    latent_size = datasets[0][0].shape[-1]
+
+    # Latents and camera params (lookat x, lookat y, distance, azimuth, elevation) are written directly to the inputs
+    inputs = np.empty([num_samples, latent_size + 5], dtype=np.float32)
+    target_coords = np.empty([num_samples, 2], dtype=np.float32)
+
+    offset = 0
+    for dataset in datasets:
+
+        samples = slice(offset, offset + dataset[0].shape[0])
+        offset = samples.stop
+
+        inputs[samples, :latent_size] = dataset[0][:, 0, :] # Bug fix
 
         if len(dataset) < 7:
             # Datasets without lookats (This part can be removed in the future)
-            latents.append(dataset[0][:, 0, :])
-            lookat_values = np.zeros([dataset[0].shape[0], 2])
-            lookat_values[:, :] = LOOK_AT[:2]
-
-            lookats.append(lookat_values)
-            camera_distances.append(dataset[1])
-            azimuths.append(dataset[2])
-            elevations.append(dataset[3])
-            cup_ids.append(dataset[4])
-            target_coords.append(dataset[5])
+            inputs[samples, latent_size:latent_size + 2] = LOOK_AT[:2]
+            inputs[samples, latent_size + 2] = dataset[1]
+            inputs[samples, latent_size + 3] = dataset[2]
+            inputs[samples, latent_size + 4] = dataset[3]
+            target_coords[samples] = dataset[5]
         else:
-
-            latents.append(dataset[0][:, 0, :]) # Bug fix
-            lookats.append(dataset[1][:, :2])
-            camera_distances.append(dataset[2])
-            azimuths.append(dataset[3])
-            elevations.append(dataset[4])
-            cup_ids.append(dataset[5])
-            target_coords.append(dataset[6])
-
-    # Arrays to numpy
-    latents = np.concatenate(latents)
-    lookats = np.concatenate(lookats)
-    camera_distances = np.concatenate(camera_distances)
-    azimuths = np.concatenate(azimuths)
-    elevations = np.concatenate(elevations)
-    target_coords = np.concatenate(target_coords)
-    cup_ids = np.concatenate(cup_ids)
-
-    lookats = (lookats - (np.array(LOOK_AT[:2]) - LOOK_AT_EPSILON)) / (LOOK_AT_EPSILON * 2)
-    camera_distances = (camera_distances - (DISTANCE - DISTANCE_EPSILON)) / (DISTANCE_EPSILON * 2)
-    azimuths = (azimuths - (AZIMUTH - AZIMUTH_EPSILON)) / (AZIMUTH_EPSILON * 2)
-    elevations = (elevations - (ELEVATION - ELEVATION_EPSILON)) / (ELEVATION_EPSILON * 2)
+            inputs[samples, latent_size:latent_size + 2] = dataset[1][:, :2]
+            inputs[samples, latent_size + 2] = dataset[2]
+            inputs[samples, latent_size + 3] = dataset[3]
+            inputs[samples, latent_size + 4] = dataset[4]
+            target_coords[samples] = dataset[6]
+
+    del datasets
+
+    # Normalize the camera params in place
+    camera_params = inputs[:, latent_size:]
+    param_mins = np.array([LOOK_AT[0] - LOOK_AT_EPSILON, LOOK_AT[1] - LOOK_AT_EPSILON, DISTANCE - DISTANCE_EPSILON,
+                           AZIMUTH - AZIMUTH_EPSILON, ELEVATION - ELEVATION_EPSILON], dtype=np.float32)
+    param_ranges = 2 * np.array([LOOK_AT_EPSILON, LOOK_AT_EPSILON, DISTANCE_EPSILON, AZIMUTH_EPSILON, ELEVATION_EPSILON],
+                                dtype=np.float32)
+    np.subtract(camera_params, param_mins, out=camera_params)
+    np.divide(camera_params, param_ranges, out=camera_params)
 
     if fixed_camera:
 
-        # The first camera params
-        distance = camera_distances[0]
-        azimuth = azimuths[0]
-        elevation = elevations[0]
-        lookat = lookats[0]
+        # Samples that share the first camera params (lookat, distance, azimuth and elevation)
+        fixed_indices = (camera_params == camera_params[0]).all(axis=1)
 
-        fixed_indices = camera_distances == distance
-        fixed_indices = fixed_camera * (lookats == lookat)
-        fixed_indices = fixed_indices * (elevations == azimuth)
-        fixed_indices = fixed_indices * (azimuths == elevation)
-
-        inputs = latents[fixed_indices]
+        inputs = inputs[fixed_indices, :latent_size]
         target_coords = target_coords[fixed_indices]
 
-    else:
-        inputs = np.concatenate([latents, lookats, camera_distances[:, None], azimuths[:, None], elevations[:, None]], axis=1)
-
     print(inputs.shape)
 
     if debug:
@@ -115,14 +102,18 @@ def load_dataset(perception_name, fixed_camera, debug):
         inputs = inputs[indices]
         target_coords = target_coords[indices]
 
-    # To tensor
-    inputs = torch.Tensor(inputs)
-    target_coord = torch.Tensor(target_coords)
+    # To tensor (shares memory with the arrays)
+    inputs = torch.from_numpy(np.ascontiguousarray(inputs, dtype=np.float32))
+    target_coord = torch.from_numpy(np.ascontiguousarray(target_coords, dtype=np.float32))
     return data.TensorDataset(inputs, target_coord)
 
 
 def main(args):
 
+    # Fail before creating the policy folder or loading the models if the training data does not exist
+    data_path = Path(VAED_MODELS_PATH) / args.vaed_name / 'mujoco_latents'
+    assert data_path.is_dir(), "No training data in {}, run generate_perception_data.py first".format(data_path)
+
     save_path = os.path.join(POLICY_MODELS_PATH, args.policy_name)
     save_arguments(args, save_path)
 
@@ -139,7 +130,7 @@ def main(args):
     traj_decoder.to(device)
 
     # Load data
-    dataset = load_dataset(args.vaed_name, args.fixed_camera, args.debug)
+    dataset = load_dataset(data_path, args.fixed_camera, args.debug)
 
     # Policy
     if args.fixed_camera:
@@ -149,17 +140,77 @@ def main(args):
 
     policy.to(device)
 
+    # Joint angle unnormalization constants
+    angle_scale = torch.tensor(MAX_ANGLE - MIN_ANGLE, dtype=torch.float32, device=device)
+    angle_bias = torch.tensor(MIN_ANGLE, dtype=torch.float32, device=device)
+
+    # Forward kinematics params
+    dh_params = dh_parameters(device)
+
+    def forward_stack(latent_1):
+
+        # latent1 -> latent2
+        latent_2 = policy(latent_1)
+
+        # latent2 -> trajectory
+        trajectories = traj_decoder(latent_2)
+
+        # Reshape to trajectories
+        trajectories = action_vae.model.to_trajectory(trajectories)
+
+        # Get the last joint pose, the kinematics are solved in full precision also with mixed precision
+        end_joint_pose = trajectories[:, :, -1].float()
+        # Unnormalize
+        end_joint_pose = torch.addcmul(angle_bias, angle_scale, end_joint_pose)
+
+        # joint pose -> cartesian
+        with torch.autocast(device.type, enabled=False):
+            end_pose = end_effector_pose(end_joint_pose, dh_params)
+
+        return latent_2, end_pose
+
+    if args.compile:
+        # Batch shapes are kept static (see the training loop) so the captured CUDA graphs are replayed every step
+        forward_stack = torch.compile(forward_stack, dynamic=False, mode='reduce-overhead')
+
     optimizer = optim.Adam(policy.parameters(), lr=args.lr)
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True)
 
     print("Dataset size", dataset.__len__())
     train_size = int(dataset.__len__() * 0.7)
     test_size = dataset.__len__() - train_size
 
-    trainset, testset = data.random_split(dataset, (train_size, test_size))
+    # The whole dataset fits in memory, so it is moved to the device once and batches are sliced from it
+    dataset_inputs = dataset.tensors[0].to(device)
+    dataset_targets = dataset.tensors[1].to(device)
 
-    train_loader = data.DataLoader(trainset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_processes)
-    test_loader = data.DataLoader(testset, batch_size=10000)
+    # The train/validation split is reproducible with the seed
+    indices = torch.randperm(dataset.__len__(), generator=torch.Generator().manual_seed(args.seed)).to(device)
+    train_inputs, train_coords = dataset_inputs[indices[:train_size]], dataset_targets[indices[:train_size]]
+    test_inputs, test_coords = dataset_inputs[indices[train_size:]], dataset_targets[indices[train_size:]]
+
+    batch_size = min(args.batch_size, train_size)
+
+    if args.compile:
+        # The last incomplete batch is dropped to keep the batch shape constant for the captured CUDA graphs
+        num_train_samples = train_size // batch_size * batch_size
+    else:
+        num_train_samples = train_size
+
+    # Results (end pose, target pose, latent) are staged on the device and copied to the host in one transfer.
+    # The first rows are for the training samples and the rest for the validation samples.
+    target_size = dataset_targets.shape[1]
+    results_shape = (num_train_samples + test_size, 2 + target_size + args.traj_latent)
+    staged_results = torch.empty(results_shape, device=device)
+    host_results = torch.empty(results_shape, pin_memory=device.type == 'cuda')
+
+    results = host_results.numpy()
+    poses = results[:, :2]
+    targets = results[:, 2:2 + target_size]
+    latents = results[:, 2 + target_size:]
+
+    train_poses, val_poses = poses[:num_train_samples], poses[num_train_samples:]
+    train_targets, val_targets = targets[:num_train_samples], targets[num_train_samples:]
 
     best_val = np.inf
 
@@ -171,93 +222,50 @@ def main(args):
 
         print("Epoch {}".format(epoch + 1))
 
+        # The results are collected and plotted only every plot_every epochs (if set) and after the last one
+        plot_epoch = epoch == args.num_epoch - 1 or (args.plot_every > 0 and (epoch + 1) % args.plot_every == 0)
+
         policy.train()
         # Training
-        train_losses = []
-        end_poses = []
-        target_poses = []
-        latents = []
-
-        for input, target_pose in train_loader:
+        # The loss is accumulated on the device to avoid a synchronization per batch
+        train_loss_sum = torch.zeros((), device=device)
 
-            # latent1 -> latent2
-            latent_1, target_pose = input.to(device), target_pose.to(device)
+        batch_indices = torch.randperm(train_size, device=device)
 
-            latent_2 = policy(Variable(latent_1))
+        for i in range(0, num_train_samples, batch_size):
 
-            # latent2 -> trajectory
-            trajectories = traj_decoder(latent_2)
+            latent_1 = train_inputs[batch_indices[i:i + batch_size]]
+            target_pose = train_coords[batch_indices[i:i + batch_size]]
 
-            # Reshape to trajectories
-            trajectories = action_vae.model.to_trajectory(trajectories)
-
-            # Get the last joint pose
-            end_joint_pose = trajectories[:, :, -1]
-            # Unnormalize
-            end_joint_pose = (MAX_ANGLE - MIN_ANGLE) * end_joint_pose + MIN_ANGLE
-
-            # joint pose -> cartesian
-            end_pose = end_effector_pose(end_joint_pose, device)
-
-            loss = F.mse_loss(end_pose, target_pose)
+            with torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.amp):
+                latent_2, end_pose = forward_stack(latent_1)
+                loss = F.mse_loss(end_pose, target_pose)
 
             loss.backward()
             optimizer.step()
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
+
+            train_loss_sum += loss.detach() * latent_1.shape[0]
 
-            train_losses.append(loss.item())
-            end_poses.append(end_pose.detach().cpu().numpy())
-            target_poses.append(target_pose.cpu().numpy())
-            latents.append(latent_2.detach().cpu().numpy())
+            if plot_epoch:
+                staged_results[i:i + latent_1.shape[0]] = torch.cat([end_pose.detach(), target_pose, latent_2.detach().float()], 1)
 
-        avg_loss = np.mean(train_losses)
+        avg_loss = (train_loss_sum / num_train_samples).item()
         avg_train_losses.append(avg_loss)
         print("Average error distance (training) {}".format(np.sqrt(avg_loss)))
 
-        train_poses = np.concatenate(end_poses)
-        train_targets = np.concatenate(target_poses)
-
         # Validation
 
         policy.eval()
-        val_losses = []
-        end_poses = []
-        target_poses = []
-
-        for latent_1, target_pose in test_loader:
-
-            # latent1 -> latent2
-            latent_1, target_pose = latent_1.to(device), target_pose.to(device)
-            latent_2 = policy(Variable(latent_1))
-
-            # latent2 -> trajectory
-            trajectories = traj_decoder(latent_2)
-
-            # Reshape to trajectories
-            trajectories = action_vae.model.to_trajectory(trajectories)
 
-            # Get the last joint pose
-            end_joint_pose = trajectories[:, :, -1]
-
-            # Unnormalize
-            end_joint_pose = (MAX_ANGLE - MIN_ANGLE) * end_joint_pose + MIN_ANGLE
-
-            # joint pose -> cartesian
-            end_pose = end_effector_pose(end_joint_pose, device)
+        # The whole validation set is evaluated at once
+        latent_1, target_pose = test_inputs, test_coords
 
+        with torch.inference_mode(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.amp):
+            latent_2, end_pose = forward_stack(latent_1)
             loss = F.mse_loss(end_pose, target_pose)
 
-            end_poses.append(end_pose.detach().cpu().numpy())
-
-            val_losses.append(loss.item())
-            end_poses.append(end_pose.detach().cpu().numpy())
-            target_poses.append(target_pose.cpu().numpy())
-            latents.append(latent_2.detach().cpu().numpy())
-
-        avg_loss = np.mean(val_losses)
-        val_poses = np.concatenate(end_poses)
-        val_targets = np.concatenate(target_poses)
-        latents = np.concatenate(latents)
+        avg_loss = loss.item()
 
         avg_val_losses.append(avg_loss)
         print("Average error distance (validation) {}".format(np.sqrt(avg_loss)))
@@ -266,15 +274,17 @@ def main(args):
             best_val = avg_loss
             torch.save(policy.state_dict(), os.path.join(save_path, '{}_model.pth.tar'.format(epoch)))
 
-        plot_scatter(train_poses, train_targets, os.path.join(save_path, 'train_scatter.png'))
-        plot_scatter(val_poses, val_targets, os.path.join(save_path, 'val_scatter.png'))
-        poses = np.concatenate([train_poses, val_poses])
-        targets = np.concatenate([train_targets, val_targets])
-        plot_scatter(poses, targets, os.path.join(save_path, 'full_scatter.png'))
-        plot_latent_distributions(latents, os.path.join(save_path, 'latents_distribution.png'))
+        if plot_epoch:
+            staged_results[num_train_samples:] = torch.cat([end_pose, target_pose, latent_2.float()], 1)
+            host_results.copy_(staged_results)
+
+            plot_scatter(train_poses, train_targets, os.path.join(save_path, 'train_scatter.png'))
+            plot_scatter(val_poses, val_targets, os.path.join(save_path, 'val_scatter.png'))
+            plot_scatter(poses, targets, os.path.join(save_path, 'full_scatter.png'))
+            plot_latent_distributions(latents, os.path.join(save_path, 'latents_distribution.png'))
 
-        plot_loss(avg_train_losses, avg_val_losses, 'Avg mse', os.path.join(save_path, 'avg_mse.png'))
-        plot_loss(np.log(avg_train_losses), np.log(avg_val_losses), 'Avg mse in log scale', os.path.join(save_path, 'avg_log_mse.png'))
+            plot_loss(avg_train_losses, avg_val_losses, 'Avg mse', os.path.join(save_path, 'avg_mse.png'))
+            plot_loss(np.log(avg_train_losses), np.log(avg_val_losses), 'Avg mse in log scale', os.path.join(save_path, 'avg_log_mse.png'))
 
 
 if __name__ == '__main__':
@@ -33,63 +33,78 @@ class Predictor(nn.Module):
                     torch.nn.init.constant_(m.bias, 0)
 
 
-def DH(theta, d, r, alpha, device):
+# Denavit-Hartenberg parameters of the arm (the last link is the flange)
+DH_ALPHAS = [0, -np.pi/2, np.pi/2, np.pi/2, -np.pi/2, np.pi/2, np.pi/2, 0]
+DH_DS = [0.333, 0, 0.316, 0, 0.384, 0, 0, 0.107]
+DH_RS = [0, 0, 0, 0.0825, -0.0825, 0, 0.088, 0]
+
+
+def DH(theta, d, r, alpha):
 
     """
-     Calculates the Denavit-Hartenberg Matrix
+     Calculates the Denavit-Hartenberg Matrices of a batch of links
      where
      d: offset along previous z to the common normal
      theta: angle about previous z, from old x to new x
      r: length of the common normal (aka a, but if using this notation, do not confuse with alpha).
      Assuming a revolute joint, this is the radius about previous z.
      alpha: angle about common normal, from old z axis to new z axis
-    """
 
-    T = torch.zeros([theta.shape[0], 4, 4]).to(device)
-    T[:, :, :] = torch.eye(4).to(device)
+     theta is of shape (batch, links) and d, r, alpha are of shape (links). Returns (batch, links, 4, 4).
+    """
 
     cTheta = torch.cos(theta)
     sTheta = torch.sin(theta)
-    calpha = torch.cos(alpha)
-    salpha = torch.sin(alpha)
+    calpha = torch.cos(alpha).expand_as(theta)
+    salpha = torch.sin(alpha).expand_as(theta)
+
+    zeros = torch.zeros_like(theta)
+    ones = torch.ones_like(theta)
+
+    T = torch.stack([
+        cTheta, -sTheta, zeros, r.expand_as(theta),
+        sTheta * calpha, cTheta * calpha, -salpha, -d * salpha,
+        sTheta * salpha, cTheta * salpha, calpha, d * calpha,
+        zeros, zeros, zeros, ones], -1)
+
+    return T.view(theta.shape + (4, 4))
 
-    T[:, 0, 0] = cTheta
-    T[:, 0, 1] = -sTheta
-    T[:, 0, 2] = 0.0
-    T[:, 0, 3] = r
 
-    T[:, 1, 0] = sTheta * calpha
-    T[:, 1, 1] = cTheta * calpha
-    T[:, 1, 2] = -salpha
-    T[:, 1, 3] = - d * salpha
+def chain_transforms(T):
 
-    T[:, 2, 0] = sTheta * salpha
-    T[:, 2, 1] = cTheta * salpha
-    T[:, 2, 2] = calpha
-    T[:, 2, 3] = d * calpha
+    """
+     Composes a chain of transforms T[:, 0] @ T[:, 1] @ ... of shape (batch, links, 4, 4).
+     Neighbouring pairs are multiplied in a single batched matmul, so the chain takes log2(links) steps.
+    """
+
+    while T.shape[1] > 1:
+        if T.shape[1] % 2 == 1:
+            eye = torch.eye(4, dtype=T.dtype, device=T.device).expand(T.shape[0], 1, 4, 4)
+            T = torch.cat([T, eye], 1)
+        T = torch.matmul(T[:, 0::2], T[:, 1::2])
+
+    return T[:, 0]
 
-    return T
 
-def end_effector_pose(thetas, device):
+def dh_parameters(device):
+
+    """
+     Returns the DH parameter tensors (alphas, ds, rs) of the arm on the given device.
+     Create them once and pass them to end_effector_pose to avoid host to device copies per call.
+    """
 
-    alphas = torch.Tensor([0, -np.pi/2, np.pi/2, np.pi/2, -np.pi/2, np.pi/2, np.pi/2, 0]).to(device)
-    ds = torch.Tensor([0.333, 0, 0.316, 0, 0.384, 0, 0, 0.107]).to(device)
-    rs = torch.Tensor([0, 0, 0, 0.0825, -0.0825, 0, 0.088, 0]).to(device)
+    return tuple(torch.tensor(param, dtype=torch.float32, device=device) for param in (DH_ALPHAS, DH_DS, DH_RS))
 
-    T = torch.zeros([thetas.shape[0], 4, 4]).to(device)
-    T[:, :, :] = torch.eye(4).to(device)
 
-    # Base link coordinates
-    T[:, 0, 3] = 0.0
-    T[:, 1, 3] = 0.0
-    T[:, 2, 3] = 0.0
+def end_effector_pose(thetas, dh_params):
 
-    for idx in range(0, len(alphas) - 1):
-        T_i = DH(thetas[:, idx], ds[idx], rs[idx], alphas[idx], device)
-        T = T.bmm(T_i)
+    alphas, ds, rs = dh_params
 
-    T_i = DH(torch.zeros(thetas.shape[0]).to(device), ds[-1], rs[-1], alphas[-1], device)
-    T = T.bmm(T_i)
+    # The flange link does not have a joint
+    thetas = torch.cat([thetas[:, :len(DH_ALPHAS) - 1], thetas.new_zeros(thetas.shape[0], 1)], 1)
+    links = DH(thetas, ds, rs, alphas)
 
-    return torch.stack((T[:, 0, 3], T[:, 1, 3]), 1)
+    # Base link coordinates are at the origin
+    T = chain_transforms(links)
 
+    return T[:, :2, 3]
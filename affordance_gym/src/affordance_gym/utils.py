@@ -60,9 +60,15 @@ def parse_policy_arguments(parser):
 def parse_policy_train_arguments(parser):
 
     parser.add_argument('--num-epoch', default=1000, type=int)
-    parser.add_argument('--batch-size', default=124, type=int)
-    parser.add_argument('--lr', default=1.e-3, type=float, help='learning rate')
-    parser.add_argument('--num-processes', default=16, type=int)
+    parser.add_argument('--batch-size', default=512, type=int)
+    parser.add_argument('--lr', default=2.e-3, type=float, help='learning rate')
+    parser.add_argument('--plot-every', default=10, type=int, help='Plots the training results every nth epoch, 0 plots only after the last epoch')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the train/validation split')
+    parser.add_argument('--num-processes', default=16, type=int, help='Deprecated and ignored, the training data is batched on the device without worker processes')
+    parser.add_argument('--amp', dest='amp', action='store_true', help='Runs the policy and the trajectory decoder in bfloat16 mixed precision')
+    parser.set_defaults(amp=False)
+    parser.add_argument('--compile', dest='compile', action='store_true', help='Compiles the policy forward pass with torch.compile (CUDA graphs)')
+    parser.set_defaults(compile=False)
 
 
 def sample_visualize(image, affordance_arr, sample_path, id):
@@ -91,16 +97,18 @@ def sample_visualize(image, affordance_arr, sample_path, id):
     plt.close(fig)
 
 
+# CUDA availability is checked once per process
+_DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
 def use_cuda():
 
-    use_cuda = torch.cuda.is_available()
-    if use_cuda:
+    if _DEVICE.type == 'cuda':
         print('GPU works!')
     else:
-        for i in range(10):
-            print('YOU ARE NOT USING GPU')
+        print('YOU ARE NOT USING GPU')
 
-    return torch.device('cuda' if use_cuda else 'cpu')
+    return _DEVICE
 
 def save_arguments(args, save_path):
 